@@ -9,22 +9,80 @@ import errno
 import os
 import select
 import subprocess
+import time
 from Interrupt_utility import InterruptUtility
 from QSFP_utility import QSFPUtility
 from SFP_utility import SFPUtility
+from const.const import PortStatus
 from cpld.cpld import CPLD
 from eeprom.eeprom import EEPRom
+from gpio.ioexp import IOExpander
 from vyatta.platform.basesfphelper import BaseSfpHelper
 from vyatta.platform.basesfphelper import ModuleNotPresentException
 from vyatta.phy.basephy import PhyNotFoundException
 
 class UfiSfpHelper(BaseSfpHelper):
 
-    def __init__(self, sfpd):
+    # CPLD port interrupts (REG_PORT_INTR, active low) and the expander
+    # whose inputs raise each of them
+    PORT_INTR_IOEXPS = {
+        "INT_SFP_FLT_N0": "9535_SFP3",
+        "INT_SFP_FLT_N1": "9535_SFP4",
+        "INT_SFP_LOS_N0": "9535_SFP9",
+        "INT_SFP_LOS_N1": "9535_SFP10",
+        "INT_SFP_ABS_N0": "9535_SFP7",
+        "INT_SFP_ABS_N1": "9535_SFP8",
+        "INT_QSFP28": "9535_QSFP",
+    }
+
+    # Defaults of the constructor tunables.
+    # Seconds of GPIO15 wakeups collapsed into one scan
+    COALESCE_WINDOW = 0.05
+    # Seconds a presence change must hold before sfpd is told
+    DEBOUNCE_TIME = 0.2
+    # Insertions reported per second, each one makes sfpd read the EEPROM
+    EEPROM_READ_RATE = 4.0
+    EEPROM_READ_BURST = 4
+
+    # Identity bytes (offset, length) read to tell modules apart:
+    # identifier, vendor OUI and serial number. QSFP ones are on upper
+    # page 00h.
+    SFP_FINGERPRINT = [(0, 1), (37, 3), (68, 16)]
+    QSFP_FINGERPRINT = [(128, 1), (165, 3), (196, 16)]
+    # Presence changes drop a module's cache entry. Seconds after which
+    # the identity is read again, for swaps the expander interrupts
+    # missed.
+    FINGERPRINT_TTL = 60.0
+    # Device offset ranges always read from the module, per page: A2h
+    # diagnostics and status, and the whole QSFP lower page (flags,
+    # monitors, control)
+    EEPROM_LIVE = {
+        ('SFP', "A2"): (96, 128),
+        ('QSFP', "lower"): (0, 128),
+    }
+
+    def __init__(self, sfpd, coalesce_window=COALESCE_WINDOW, debounce_time=DEBOUNCE_TIME,
+                 eeprom_read_rate=EEPROM_READ_RATE, eeprom_read_burst=EEPROM_READ_BURST):
+        self.coalesce_window = coalesce_window
+        self.debounce_time = debounce_time
+        self.eeprom_read_rate = eeprom_read_rate
+        self.eeprom_read_burst = eeprom_read_burst
         self.sfp_plugged = dict.fromkeys(SFPUtility().VALID_PORTS, False)
         self.qsfp_plugged = dict.fromkeys(QSFPUtility().VALID_PORTS, False)
         self.sfpd = sfpd
         self.eeprom = EEPRom()
+        self.ioexp = IOExpander()
+        self.cpld = CPLD()
+        # Last port expander snapshot, see _walk_ports()
+        self.snapshot = None
+        # (porttype, port) -> (presence, first seen), changes not yet reported
+        self.pending = {}
+        self.eeprom_tokens = float(self.eeprom_read_burst)
+        self.eeprom_tokens_time = time.monotonic()
+        # (porttype, port) -> [fingerprint, {page: data}, time checked] of
+        # static EEPROM contents; SFP pages are 'A0'/'A2', QSFP ones upper
+        # pages 0-3
+        self.eeprom_cache = {}
 
     class UfiBus():
         def __init__(self, resource, port):
@@ -117,17 +175,114 @@ class UfiSfpHelper(BaseSfpHelper):
         else:
             raise Exception("unexpected port type {}".format(portname))
 
+    def _fingerprint(self, porttype, port):
+        if porttype == 'SFP':
+            return tuple(tuple(self.eeprom.read_range(porttype, port, EEPRom.I2C_ADDR_EEPROM_SFP_A0,
+                                                      offset, length))
+                         for (offset, length) in self.SFP_FINGERPRINT)
+        fingerprint = []
+        page = EEPRom.QSFP_EEPROM_UPPER_PAGE_00
+        for (offset, length) in self.QSFP_FINGERPRINT:
+            fingerprint.append(tuple(self.eeprom.read_range(porttype, port, EEPRom.I2C_ADDR_EEPROM_QSFP_A0,
+                                                            offset, length, page)))
+            # Selected once
+            page = None
+        return tuple(fingerprint)
+
+    def _cached_pages(self, porttype, port):
+        # Static EEPROM pages of the module in the port. The identity is
+        # read when the entry is made and after FINGERPRINT_TTL, the entry
+        # is dropped when the presence changes or another module answers.
+        # Raises OSError when no module answers.
+        key = (porttype, port)
+        now = time.monotonic()
+        entry = self.eeprom_cache.get(key)
+        if entry is not None and now - entry[2] < self.FINGERPRINT_TTL:
+            return entry[1]
+        fingerprint = self._fingerprint(porttype, port)
+        if entry is None or entry[0] != fingerprint:
+            entry = [fingerprint, {}, now]
+            self.eeprom_cache[key] = entry
+        entry[2] = now
+        return entry[1]
+
+    def _eeprom_page(self, porttype, offset):
+        # Where flat read_eeprom() offset lives: (page, device address,
+        # page select, device offset, flat offset where the page ends).
+        # SFP is A0h then A2h, QSFP the lower page then upper pages 00h-03h.
+        if porttype == 'SFP':
+            if offset < 256:
+                return ("A0", EEPRom.I2C_ADDR_EEPROM_SFP_A0, None, offset, 256)
+            return ("A2", EEPRom.I2C_ADDR_EEPROM_SFP_A2, None, offset - 256, 512)
+        if offset < 128:
+            return ("lower", EEPRom.I2C_ADDR_EEPROM_QSFP_A0, None, offset, 128)
+        page = (offset - 128) // 128
+        return (page, EEPRom.I2C_ADDR_EEPROM_QSFP_A0, page, 128 + (offset - 128) % 128, 256 + page * 128)
+
+    def _static_bytes(self, porttype, port, pages, page, i2c_address, page_sel, start, end):
+        # Device bytes start..end of a static page, reading only the ones
+        # not cached yet
+        data = pages.setdefault(page, [None] * 256)
+        offset = start
+        while offset < end:
+            if data[offset] is not None:
+                offset += 1
+                continue
+            run_end = offset
+            while run_end < end and data[run_end] is None:
+                run_end += 1
+            read = self.eeprom.read_range(porttype, port, i2c_address,
+                                          offset, run_end - offset, page_sel)
+            if len(read) != run_end - offset:
+                # Don't keep a page with a hole or a shifted tail
+                self.eeprom_cache.pop((porttype, port), None)
+                raise OSError(errno.EIO, "Short EEPROM read from " + porttype + " " + str(port))
+            data[offset:run_end] = read
+            offset = run_end
+        return data[start:end]
+
+    def _read_flat(self, porttype, port, offset, length):
+        # Bytes offset..offset+length of the flat EEPROM layout, live
+        # regions from the module and the rest through the cache
+        data = []
+        pages = None
+        end = offset + length
+        while offset < end:
+            (page, i2c_address, page_sel, dev_offset, page_end) = self._eeprom_page(porttype, offset)
+            dev_end = dev_offset + min(end, page_end) - offset
+            live = self.EEPROM_LIVE.get((porttype, page))
+            # Cut the piece at the edges of the live region
+            if live is not None and dev_offset < live[0]:
+                dev_end = min(dev_end, live[0])
+            elif live is not None and dev_offset < live[1]:
+                dev_end = min(dev_end, live[1])
+            try:
+                if live is not None and live[0] <= dev_offset < live[1]:
+                    data += self.eeprom.read_range(porttype, port, i2c_address,
+                                                   dev_offset, dev_end - dev_offset, page_sel)
+                else:
+                    if pages is None:
+                        pages = self._cached_pages(porttype, port)
+                    data += self._static_bytes(porttype, port, pages, page, i2c_address,
+                                               page_sel, dev_offset, dev_end)
+            except OSError:
+                prefix = 'xe' if porttype == 'SFP' else 'ce'
+                raise ModuleNotPresentException(prefix + str(port) + ' page ' + str(page) + ' not available')
+            offset += dev_end - dev_offset
+        return data
+
     def query_eeprom(self, porttype, port):
         pages = []
         if porttype == 'SFP':
-            a0_data = []
             try:
-                a0_data = self.eeprom.dump_sfp_eeprom(port, page="A0")
+                dmt = self._static_bytes(porttype, port, self._cached_pages(porttype, port), "A0",
+                                         EEPRom.I2C_ADDR_EEPROM_SFP_A0, None,
+                                         self.DMT_BYTE, self.DMT_BYTE + 1)[0]
             except OSError:
                 raise ModuleNotPresentException(porttype + ' ' + str(port) + ' page A0 not available')
             pages.append(0xa0)
             # We don't support address changing, so treat that as no DDM info
-            dmt_implemented = a0_data[self.DMT_BYTE] & (self.DMT_IMPL|self.DMT_ADDR_CHNG_REQ) == self.DMT_IMPL
+            dmt_implemented = dmt & (self.DMT_IMPL|self.DMT_ADDR_CHNG_REQ) == self.DMT_IMPL
             if dmt_implemented:
                 pages.append(0xa2)
         elif porttype == 'QSFP':
@@ -139,90 +294,160 @@ class UfiSfpHelper(BaseSfpHelper):
         return pages
 
     def read_eeprom(self, porttype, port, offset=None, length=None):
-        data = []
         if porttype == 'SFP':
-            if offset is None:
-                offset = 0
-            if length is None:
-                length = 512
-            for page in range((offset // 256) * 256, offset + length, 256):
-                try:
-                    if page == 0:
-                        data += self.eeprom.dump_sfp_eeprom(port, page="A0")
-                    else:
-                        data += self.eeprom.dump_sfp_eeprom(port, page="A2")
-                except OSError:
-                    raise ModuleNotPresentException('xe' + str(port) + ' page ' + str(page) + ' not available')
-
-            # Only required pages were retrieved, so now trim head and
-            # tail appropriately
-            data = data[offset % 256:offset % 256 + length]
+            size = 512
         elif porttype == 'QSFP':
-            if offset is None:
-                offset = 0
-            if length is None:
-                length = 128 + 4 * 128
-            # Handle lower and upper page 00h specially since these
-            # are retrieved in one go
-            if offset < 256:
-                try:
-                    data += self.eeprom.dump_qsfp_eeprom(port, 0)
-                except OSError:
-                    raise ModuleNotPresentException('ce' + str(port) + ' page 0  not available')
-                # Handle offsets/lengths within the 256-length
-                # page. Remainders will be dealt with below
-                if offset // 128 == 1:
-                    data = data[128:]
-                if (length + offset) // 128 == 0:
-                    data = data[:128]
-            for page in range(max(((offset - 256) // 128) * 128, 0), offset - 256 + length, 128):
-                try:
-                    data += self.eeprom.dump_qsfp_eeprom(port, page // 128 + 1)
-                except OSError:
-                    raise ModuleNotPresentException('ce' + str(port) + ' page ' + str(page) + ' not available')
-            # Only required pages were retrieved, so now trim head and
-            # tail appropriately
-            data = data[offset % 128:offset % 128 + length]
+            size = 128 + 4 * 128
         else:
             raise Exception("unexpected port type {}".format(porttype))
+        if offset is None:
+            offset = 0
+        if length is None:
+            length = size
+        # Only the requested bytes are read, nothing past the last page
+        length = max(min(length, size - offset), 0)
+        data = self._read_flat(porttype, port, offset, length)
         return bytes(data)
 
-    def _walk_ports(self, sfp, qsfp):
-        for port in SFPUtility().VALID_PORTS:
-            presence = False
+    def _interrupting_ioexps(self):
+        # Expanders behind a pending CPLD port interrupt, or None when
+        # that can't be told and every expander has to be read
+        try:
+            interrupts = self.cpld.get_port_status_interrupt()
+        except Exception:
+            return None
+        names = [name for (intr, name) in self.PORT_INTR_IOEXPS.items()
+                 if interrupts[intr] == 0]
+        if len(names) == 0:
+            # e.g. an over current interrupt, or the source went away
+            return None
+        return names
+
+    def _walk_ports(self, ioexp_names=None, debounce=True):
+        # Snapshot the port expanders, only ioexp_names when given; reading
+        # them also clears the presence/tx_fault/rx_lost interrupts
+        if self.snapshot is None:
+            ioexp_names = None
+        snapshot = None
+        for attempt in range(2):
+            # A failed read drops the cached mux state, so retry once
+            # before reporting every port as removed
             try:
-                presence = sfp.get_presence(port)["presence"] == "presence"
-                # Need to clear by read presence/tx_fault/rx_lost
-                rx_lost = sfp.get_rx_lost(port)["rx_lost"]
-                tx_fault = sfp.get_tx_fault(port)["tx_flt"]
+                snapshot = self.ioexp.snapshot_ports(ioexp_names, self.snapshot)
+                break
             except OSError:
                 pass
-            if presence != self.sfp_plugged[port]:
-                self.sfp_plugged[port] = presence
-                self.sfpd.on_sfp_presence_change('xe' + str(port),
-                                                 'SFP', port, presence)
+        if snapshot is None and ioexp_names is not None:
+            return self._walk_ports(None, debounce)
+        self.snapshot = snapshot
+
+        now = time.monotonic()
+        for port in SFPUtility().VALID_PORTS:
+            presence = False
+            if snapshot is not None:
+                presence = (snapshot["sfp_presence"] >> port) & 0x1 == PortStatus.SFP_PRESENCE
+            self._update_port('SFP', port, presence, now, debounce)
 
         for port in QSFPUtility().VALID_PORTS:
             presence = False
-            try:
-                presence = qsfp.get_presence(port)["presence"] == "presence"
-            except OSError:
-                pass
-            if presence != self.qsfp_plugged[port]:
-                self.qsfp_plugged[port] = presence
-                self.sfpd.on_sfp_presence_change('ce' + str(port),
-                                                 'QSFP', port, presence)
+            if snapshot is not None:
+                presence = (snapshot["qsfp_presence"] >> port) & 0x1 == PortStatus.QSFP_PRESENCE
+            self._update_port('QSFP', port, presence, now, debounce)
+
+        self._flush_pending(now)
+
+    def _plugged(self, porttype):
+        if porttype == 'SFP':
+            return self.sfp_plugged
+        return self.qsfp_plugged
+
+    def _notify(self, porttype, port, presence):
+        self._plugged(porttype)[port] = presence
+        prefix = 'xe' if porttype == 'SFP' else 'ce'
+        self.sfpd.on_sfp_presence_change(prefix + str(port),
+                                         porttype, port, presence)
+
+    def _update_port(self, porttype, port, presence, now, debounce):
+        key = (porttype, port)
+        if presence != self._plugged(porttype)[port] or key in self.pending:
+            # The module may be a different one by now
+            self.eeprom_cache.pop(key, None)
+            EEPRom.forget_port(porttype, port)
+        if presence == self._plugged(porttype)[port]:
+            # No change, or a bounce that went back before it was reported
+            self.pending.pop(key, None)
+            return
+        if not debounce:
+            self.pending.pop(key, None)
+            self._notify(porttype, port, presence)
+            return
+        if key not in self.pending or self.pending[key][0] != presence:
+            self.pending[key] = (presence, now)
+
+    def _take_eeprom_token(self, now):
+        elapsed = now - self.eeprom_tokens_time
+        self.eeprom_tokens_time = now
+        self.eeprom_tokens = min(float(self.eeprom_read_burst),
+                                 self.eeprom_tokens + elapsed * self.eeprom_read_rate)
+        if self.eeprom_tokens < 1.0:
+            return False
+        self.eeprom_tokens -= 1.0
+        return True
+
+    def _flush_pending(self, now):
+        # Report the changes that held for debounce_time, oldest first.
+        # Removals always go out, insertions wait for an EEPROM read token.
+        for (key, (presence, since)) in sorted(self.pending.items(), key=lambda item: item[1][1]):
+            if now - since < self.debounce_time:
+                continue
+            if presence and not self._take_eeprom_token(now):
+                continue
+            del self.pending[key]
+            self._notify(key[0], key[1], presence)
+
+    def _pending_timeout(self):
+        # Milliseconds until a pending change can be confirmed, None to
+        # block until the next event
+        if len(self.pending) == 0:
+            return None
+        now = time.monotonic()
+        wait = min(since + self.debounce_time - now for (presence, since) in self.pending.values())
+        if wait <= 0:
+            # Debounced but rate limited
+            wait = (1.0 - self.eeprom_tokens) / self.eeprom_read_rate
+        return max(int(wait * 1000), 1)
+
+    def _pending_ioexps(self):
+        # Presence expanders of the ports with a pending change
+        names = set()
+        for (porttype, port) in self.pending:
+            key = "sfp_presence" if porttype == 'SFP' else "qsfp_presence"
+            for (name, entry_key, first_port, count, first_bit) in self.ioexp.PORT_SNAPSHOT_MAP:
+                if entry_key == key and first_port <= port < first_port + count:
+                    names.add(name)
+        return list(names)
+
+    def _coalesce_wakeups(self, proc, p):
+        # Let a burst of GPIO15 wakeups settle into one scan, other file
+        # events are still served meanwhile
+        deadline = time.monotonic() + self.coalesce_window
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            print(1, file=proc, flush=True)
+            for (fd, event) in p.poll(max(int(remaining * 1000), 1)):
+                if fd != proc.fileno():
+                    self.sfpd.on_file_event(fd, event)
 
     def main_loop(self, file_evmask_tuple_list):
         p = select.poll()
-        sfp = SFPUtility()
-        qsfp = QSFPUtility()
 
         for (f, evmask) in file_evmask_tuple_list:
             p.register(f, evmask)
 
         # gather state at boot
-        self._walk_ports(sfp, qsfp)
+        self._walk_ports(debounce=False)
         self.sfpd.boot_walk_complete()
 
         # disable interrupts first, then load module
@@ -242,12 +467,21 @@ class UfiSfpHelper(BaseSfpHelper):
             while True:
                 # need to enable interrupts in the kmod after each wake up
                 print(1, file=proc, flush=True)
-                evtuple_list = p.poll()
+                evtuple_list = p.poll(self._pending_timeout())
+                port_event = False
                 for (fd, event) in evtuple_list:
                     if fd == proc.fileno():
-                        self._walk_ports(sfp, qsfp)
+                        port_event = True
                     else:
                         self.sfpd.on_file_event(fd, event)
+                if port_event:
+                    self._coalesce_wakeups(proc, p)
+                    self._walk_ports(self._interrupting_ioexps())
+                elif len(evtuple_list) == 0 and len(self.pending) > 0:
+                    # Confirm the pending changes against the pins
+                    self._walk_ports(self._pending_ioexps())
 
-def new_helper(sfpd):
-    return UfiSfpHelper(sfpd)
+def new_helper(sfpd, **kwargs):
+    # kwargs: coalesce_window, debounce_time, eeprom_read_rate and
+    # eeprom_read_burst, see UfiSfpHelper
+    return UfiSfpHelper(sfpd, **kwargs)